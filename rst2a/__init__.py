@@ -33,16 +33,25 @@ for documents are in utf-8, and that footnote references should be output in
 superscript (a personal preference of the author). This may be modified at
 run-time by applications which import ``rst2a``.
 
+``DOCTREE_CACHE`` holds recently parsed document trees, keyed by a hash of
+their source, so that building several ``ReSTDocument`` instances from the same
+input only runs the (rather slow) reST parser once. Call its ``clear`` method
+to empty it. ``clear_cache`` empties it along with the caches of writer and
+tidy output kept by the submodules, for long-running applications which would
+rather have the memory back.
+
 For more information on the ``ReSTDocument`` class, see its individual
 documentation.
 """
 
-from copy import copy
-from os import chdir, extsep, getcwdu, remove, rmdir
-from os.path import isdir, isfile, splitext
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import pickle
 
-from docutils.core import publish_doctree, publish_from_doctree
-from docutils.nodes import document, image, figure, SparseNodeVisitor
+from docutils.core import publish_doctree
+from docutils.transforms import Transformer
+from docutils.utils import new_reporter
 
 from rst2a import common, html, images, latex, pdf
 
@@ -56,6 +65,58 @@ DEFAULT_SETTINGS = {
 }
 
 
+DOCTREE_CACHE = common.LRUCache(maxsize=64)
+
+
+def clear_cache():
+    """Empty the doctree, writer output, writer settings and tidy caches."""
+    DOCTREE_CACHE.clear()
+    common.PUBLISH_CACHE.clear()
+    # Picks up any changes to the docutils config files, too.
+    common.SETTINGS_TEMPLATES.clear()
+    html.TIDY_CACHE.clear()
+
+
+def parse_document(document_raw):
+    """
+    Parse a reST string into a document tree, re-using previous parses.
+    
+    Parsed trees are stored in ``DOCTREE_CACHE`` in pickled form, keyed by
+    ``common.hash_input(document_raw)``. Every call returns a fresh tree, so
+    callers may mutate the result (as the ``ImageLocalizer`` does) without
+    affecting any other document built from the same source.
+    """
+    key = common.hash_input(document_raw)
+    pickled_doctree = DOCTREE_CACHE.get(key)
+    if pickled_doctree is not None:
+        return unpickle_doctree(pickled_doctree)
+    # Each parse gets its own parser, which keeps its state machine (and the
+    # document it worked on) on the instance; only the settings are shared.
+    doctree = publish_doctree(document_raw,
+        settings=common.parser_settings())
+    DOCTREE_CACHE.set(key, pickle_doctree(doctree))
+    return doctree
+
+
+def pickle_doctree(doctree):
+    # The reporter and transformer hold references to streams and settings
+    # which cannot be pickled; they are re-created upon unpickling.
+    reporter, transformer = doctree.reporter, doctree.transformer
+    doctree.reporter = doctree.transformer = None
+    try:
+        return pickle.dumps(doctree, pickle.HIGHEST_PROTOCOL)
+    finally:
+        doctree.reporter, doctree.transformer = reporter, transformer
+
+
+def unpickle_doctree(pickled_doctree):
+    doctree = pickle.loads(pickled_doctree)
+    doctree.reporter = new_reporter(doctree.get('source', ''),
+        doctree.settings)
+    doctree.transformer = Transformer(doctree)
+    return doctree
+
+
 class ReSTDocument (object):
     
     """
@@ -108,45 +169,44 @@ class ReSTDocument (object):
         the ``DEFAULT_SETTINGS`` dictionary, located within this namespace.
         
         This method will read the data from ``doc_handle`` by calling its
-        ``read`` method with no arguments, and then call the returned string's
-        ``decode`` method with 'utf-8' as the argument. On most file-like
-        classes in the Python stdlib (e.g. files, URL connections, StringIOs),
-        the former will return a ``str`` and the latter will produce a
-        ``unicode`` instance. For a third-party class to work, just make sure
-        its ``read`` method returns a string.
+        ``read`` method with no arguments. If this returns ``bytes`` (as it
+        will for files opened in binary mode, URL connections and
+        ``BytesIO`` instances), they are decoded as utf-8; ``str`` data from
+        text-mode handles is used as-is. For a third-party class to work, just
+        make sure its ``read`` method returns one of the two.
         
         The read document will then be processed using
         ``docutils.core.publish_doctree``. Ensure that documents are valid reST
         inputs - failure to do so will probably produce an error upon
-        initialization of the ``ReSTDocument`` instance.
+        initialization of the ``ReSTDocument`` instance. If the same document
+        has been parsed recently, a copy of the cached doctree is used instead
+        (see ``parse_document``).
         
         An ``ImageLocalizer`` instance is wrapped around the produced doctree;
         this eases the strain of LaTeX and PDF conversion greatly.
         
+        Optional dependencies are only looked for when they are first needed.
         If the Python installation from which this is run does not have the
         ``pdflatex`` command available (this includes most win32 systems), then
-        PDF support will be removed from the resulting ``ReSTDocument``
-        instance. If the ``tidy`` module is not available, then XHTML
-        conversion will likewise be removed.
+        ``to_pdf`` will raise an ``EnvironmentError``. If the ``tidy`` module
+        is not available, then ``to_xhtml`` will likewise raise an
+        ``ImportError``.
         """
         self.fp = doc_handle
         # Make sure document is read in utf-8. This will avoid any surprises
         # down the line, when converting the document.
-        self.document_raw = self.fp.read().decode('utf8')
-        # ``self.document`` holds a document tree instance.
-        self.document = publish_doctree(self.document_raw)
+        self.document_raw = self.fp.read()
+        if isinstance(self.document_raw, bytes):
+            self.document_raw = self.document_raw.decode('utf8')
+        # ``self.document`` holds a document tree instance, which may have been
+        # copied from the doctree cache.
+        self.document = parse_document(self.document_raw)
         # Hold some settings within the ``ReSTDocument`` instance.
         self.default_settings = settings
         # Initialize an image localizer, just in case the user wishes to
         # convert to LaTeX and have images localized, or convert to PDF, for
         # which it is necessary to localize images.
         self.img_localizer = images.ImageLocalizer(self.document)
-        # Just remove XHTML and PDF conversion capabilities if they are not
-        # supported by the system.
-        if html.tidy is None:
-            del self.to_xhtml
-        if not pdf.pdflatex_installed():
-            del self.to_pdf
     
     def to_latex(self, stylesheet_url='',
         settings=latex.DEFAULT_LATEX_OVERRIDES, *args, **kwargs):
@@ -156,8 +216,9 @@ class ReSTDocument (object):
         The ``to_latex`` method will return a string containing the produced
         LaTeX file and a list containing the locations of temporary files
         created during the LaTeX conversion. The LaTeX string returned will
-        most likely be a ``unicode``, and the list of files will be (possibly)
-        a .tex file (the stylesheet) followed by several image files.
+        most likely be a ``bytes`` instance, and the list of files will be
+        (possibly) a .tex file (the stylesheet) followed by several image
+        files.
         
         The LaTeX stylesheet is passed in the ``stylesheet_url`` keyword. The
         way of dealing with the stylesheet is quite complex, so here's a
@@ -187,41 +248,93 @@ class ReSTDocument (object):
         ``rst2a.latex.doctree_to_latex`` function.
         """
         # Create a set of conversion settings based on those given and the
-        # default settings held in the ``ReSTDocument`` instance.
-        conversion_settings = copy(self.default_settings)
-        conversion_settings.update(settings)
+        # default settings held in the ``ReSTDocument`` instance. A
+        # ``ChainMap`` layers the two without copying either.
+        conversion_settings = ChainMap(settings, self.default_settings)
         # Wrap the ``latex.doctree_to_latex`` function.
         return latex.doctree_to_latex(self.document, self.img_localizer,
-            stylesheet_url=stylesheet_url, settings=conversion_settings)
+            stylesheet_url=stylesheet_url, settings=conversion_settings,
+            *args, **kwargs)
         
     def to_html(self, stylesheet_url='', settings=html.DEFAULT_HTML_OVERRIDES,
         tidy_output=True, tidy_settings=html.DEFAULT_TIDY_HTML_OPTIONS,
         *args, **kwargs):
-        conversion_settings = copy(self.default_settings)
-        conversion_settings.update(settings)
+        conversion_settings = ChainMap(settings, self.default_settings)
         # Wrap the ``html.doctree_to_html`` function.
         return html.doctree_to_html(self.document,
-        stylesheet_url=stylesheet_url, settings=settings,
+        stylesheet_url=stylesheet_url, settings=conversion_settings,
         tidy_output=tidy_output, tidy_settings=tidy_settings, *args, **kwargs)
     
     def to_xhtml(self, stylesheet_url='', settings=html.DEFAULT_HTML_OVERRIDES,
         tidy_settings=html.DEFAULT_TIDY_XHTML_OPTIONS, *args, **kwargs):
         if 'tidy_output' in kwargs:
             del kwargs['tidy_output']
-        conversion_settings = copy(self.default_settings)
-        conversion_settings.update(settings)
+        conversion_settings = ChainMap(settings, self.default_settings)
         return html.doctree_to_xhtml(self.document,
-        stylesheet_url=stylesheet_url, settings=settings,
+        stylesheet_url=stylesheet_url, settings=conversion_settings,
         tidy_settings=tidy_settings, *args, **kwargs)
     
     def to_pdf(self, stylesheet_url='', settings=latex.DEFAULT_LATEX_OVERRIDES,
-        *args, **kwargs):
-        conversion_settings = copy(self.default_settings)
-        conversion_settings.update(settings)
+        keep_images=False, dest=None, *args, **kwargs):
+        """
+        Convert a document tree to PDF, returning the PDF data.
+        
+        This goes by way of ``to_latex`` and ``pdflatex``; see the former for
+        the meaning of ``stylesheet_url`` and ``settings``. Any images which
+        had to be localized are deleted again afterwards, unless
+        ``keep_images`` is true. In that case they stay on disk (and in the
+        doctree), so that further LaTeX or PDF conversions of this document
+        do not have to download them again; call ``cleanup_images`` once
+        they are no longer needed.
+        
+        If a writable file-like object or a connected socket is passed as
+        ``dest``, the PDF is written to it (by ``os.sendfile`` where possible)
+        and the number of bytes written is returned instead of the data
+        itself.
+        """
+        conversion_settings = ChainMap(settings, self.default_settings)
         return pdf.doctree_to_pdf(self.document, self.img_localizer,
-            stylesheet_url=stylesheet_url, settings=settings, *args, **kwargs)
+            stylesheet_url=stylesheet_url, settings=conversion_settings,
+            keep_images=keep_images, dest=dest, *args, **kwargs)
+    
+    def convert_all(self, formats=('html', 'latex', 'pdf'), max_workers=None):
+        """
+        Convert the document to several formats at once, returning a dict.
+        
+        Each of ``formats`` (any of ``'html'``, ``'xhtml'``, ``'latex'`` and
+        ``'pdf'``) is produced by the matching ``to_*`` method with its default
+        arguments, and the results are returned keyed by format name. The
+        conversions run concurrently, in up to ``max_workers`` threads (by
+        default, one per format); pdflatex and tidy do their work outside of
+        Python, so they really do overlap.
+        
+        The docutils writers modify the doctree they are given, so every
+        format works on its own copy of ``document``. The LaTeX conversion
+        localizes its images with ``img_localizer``, so that (as with
+        ``to_latex``) its temporary files can be removed afterwards with
+        ``cleanup_images``; the PDF conversion uses a localizer of its own,
+        and cleans up after itself.
+        """
+        for format_name in formats:
+            if not hasattr(self, 'to_' + format_name):
+                raise ValueError('Unknown output format: %r' % (format_name,))
+        if not formats:
+            return {}
+        pickled_doctree = pickle_doctree(self.document)
+        def convert(format_name):
+            doc_copy = copy.copy(self)
+            doc_copy.document = unpickle_doctree(pickled_doctree)
+            if format_name == 'pdf':
+                doc_copy.img_localizer = images.ImageLocalizer(
+                    doc_copy.document)
+            return getattr(doc_copy, 'to_' + format_name)()
+        with ThreadPoolExecutor(max_workers=max_workers or len(formats)) as \
+            executor:
+            futures = dict((format_name, executor.submit(convert, format_name))
+                for format_name in formats)
+            return dict((format_name, future.result())
+                for format_name, future in futures.items())
     
     def cleanup_images(self):
-        self.img_localizer.switch_mode()
-        self.document.walk(self.img_localizer)
-        self.img_localizer.switch_mode()
+        """Restore the original image URLs and delete any localized images."""
+        self.img_localizer.cleanup_images(self.document)
@@ -20,60 +20,113 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+import copy
+from functools import lru_cache
+import hashlib
+import io
+import shutil
+import socket
 import tempfile
+import threading
 import os
+from urllib.parse import urlparse
+import warnings
 
-VALID_NETLOCS = ('ftp', 'http', 'https', 'shttp', 'sftp')
+from docutils.core import publish_from_doctree
+from docutils.frontend import OptionParser
+from docutils.parsers.rst import Parser as RstParser
+from docutils.readers import doctree as doctree_reader
+from docutils.readers import standalone as standalone_reader
+from docutils.writers import get_writer_class
+
+VALID_NETLOCS = frozenset(('ftp', 'http', 'https', 'shttp', 'sftp'))
 
 def remove_dir(dirname):
-    for temp_dirname, sub_dirs, files in os.walk(dirname):
-        if (not sub_dirs) and (not files):
-            os.rmdir(temp_dirname)
-        if files:
-            for filename in files:
-                os.remove(join(temp_dirname, filename))
-        if sub_dirs:
-            for sub_dir in sub_dirs:
-                remove_dir(sub_dir)
-        os.rmdir(temp_dirname)
-    os.rmdir(dirname)
+    shutil.rmtree(dirname, ignore_errors=True)
+
+
+@lru_cache(maxsize=1024)
+def _url_scheme(url):
+    return urlparse(url)[0]
 
 
 def is_url(url, net_loc=''):
-    url_net_loc = urlparse(url)[0]
+    url_net_loc = _url_scheme(url)
     if not net_loc:
-        if url_net_loc in VALID_NETLOCS:
-            return True
-    elif hasattr(net_loc, '__iter__'):
-        if url_net_loc in net_loc:
-            return True
-    elif isinstance(net_loc, basestring) and (url_net_loc == net_loc):
-        return True
-    return False
+        return url_net_loc in VALID_NETLOCS
+    elif isinstance(net_loc, str):
+        return url_net_loc == net_loc
+    return url_net_loc in net_loc
 
 
-def stream_cp(input_handle, output_handle, block_size=1024, block_count=None):
+def stream_cp(input_handle, output_handle, block_size=65536, block_count=None):
     block_size = int(block_size)
     if block_count is None:
-        tmp_data = input_handle.read(block_size)
-        while tmp_data:
-            output_handle.write(tmp_data)
-            tmp_data = input_handle.read(block_size)
+        shutil.copyfileobj(input_handle, output_handle, block_size)
     else:
-        for i in xrange(int(block_count)):
-            output_handle.write(input_handle.read(block_size))
+        if not hasattr(input_handle, 'readinto'):
+            # Text handles can't fill a buffer in place.
+            for i in range(int(block_count)):
+                output_handle.write(input_handle.read(block_size))
+            return
+        # Re-use a single buffer rather than allocating one per block.
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        for i in range(int(block_count)):
+            n_read = input_handle.readinto(buf)
+            if not n_read:
+                break
+            output_handle.write(view[:n_read])
+
 
+def send_file(filename, output_handle):
+    # Copy a file into ``output_handle``, letting the kernel move the data
+    # when the handle has a real descriptor (files, sockets, pipes).
+    with open(filename, 'rb') as input_handle:
+        if isinstance(output_handle, socket.socket):
+            # Sockets have no ``write``; ``socket.sendfile`` uses
+            # ``os.sendfile`` where it can, and ``send`` otherwise.
+            return output_handle.sendfile(input_handle)
+        try:
+            output_fd = output_handle.fileno()
+        except (AttributeError, OSError, ValueError):
+            output_fd = None
+        if output_fd is not None and hasattr(os, 'sendfile'):
+            # Anything already buffered has to reach the descriptor first.
+            if hasattr(output_handle, 'flush'):
+                output_handle.flush()
+            size = os.fstat(input_handle.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(output_fd, input_handle.fileno(),
+                        offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError:
+                # Not every descriptor supports it; finish off normally.
+                pass
+            input_handle.seek(offset)
+        stream_cp(input_handle, output_handle)
+        return input_handle.tell()
 
-def reverse_lookup(dictionary, value, cmp=cmp):
-    for curr_key, curr_value in dictionary.items():
-        if cmp(value, curr_value) == 0:
-            return curr_key
-    raise ValueError('Value %r not found in dictionary' % (value,))
+
+def link_or_copy(src_filename, dst_filename):
+    # A hard link costs no I/O at all, but needs ``dst_filename`` to be free
+    # and on the same filesystem; otherwise, copy the data over.
+    if os.path.lexists(dst_filename):
+        os.remove(dst_filename)
+    try:
+        os.link(src_filename, dst_filename)
+    except (AttributeError, OSError):
+        shutil.copyfile(src_filename, dst_filename)
 
 
 def is_filelike(handle, mode=None):
     if mode is None:
-        if hasattr(handle, mode):
+        if hasattr(handle, 'mode'):
             mode = handle.mode
         else:
             mode = 'rw'
@@ -89,16 +142,170 @@ def is_filelike(handle, mode=None):
 
 
 def create_temp_file(filein, *args, **kwargs):
-    temp_filename = tempfile.mkstemp(*args, **kwargs)[1]
-    temp_handle = open(temp_filename, 'w')
-    if isinstance(filein, basestring):
-        temp_handle.write(filein)
-    elif is_filelike(filein):
-        stream_cp(filein, temp_handle)
-    else:
+    # Write through the descriptor ``mkstemp`` returns, rather than opening
+    # the file a second time by name.
+    temp_fd, temp_filename = tempfile.mkstemp(*args, **kwargs)
+    temp_handle = os.fdopen(temp_fd, 'wb')
+    try:
+        if isinstance(filein, str):
+            temp_handle.write(filein.encode('utf8'))
+        elif isinstance(filein, bytes):
+            temp_handle.write(filein)
+        elif is_filelike(filein):
+            # Text-mode handles return ``str`` (even from ``read(0)``), so
+            # they need to be encoded on their way into the file.
+            if isinstance(filein.read(0), str):
+                temp_handle = io.TextIOWrapper(temp_handle, encoding='utf8',
+                    newline='')
+            stream_cp(filein, temp_handle)
+        else:
+            raise TypeError("""Temporary file creation needs a file-like \
+object or string; %r received instead.""" % (filein,))
+    except BaseException:
+        # Don't leave a half-written file (or its descriptor) behind.
         temp_handle.close()
-        remove(temp_filename)
-        raise TypeError("""Temporary file creation needs a file-like object \
-or string; %r received instead.""" % (filein,))
+        os.remove(temp_filename)
+        raise
     temp_handle.close()
     return temp_filename
+
+
+def hash_input(data):
+    if isinstance(data, str):
+        data = data.encode('utf8')
+    return hashlib.sha1(data).digest()
+
+
+def default_settings(*components):
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=DeprecationWarning)
+        option_parser = OptionParser(components=components,
+            defaults={'traceback': True}, read_config_files=True)
+    return option_parser.get_default_values()
+
+
+def writer_settings(writer_name, settings_overrides):
+    # Building the option parser walks every settings spec of the reader and
+    # writer (and reads the config files); do that once per writer, then hand
+    # out copies with the overrides applied.
+    template = SETTINGS_TEMPLATES.get(writer_name)
+    if template is None:
+        template = SETTINGS_TEMPLATES[writer_name] = default_settings(
+            doctree_reader.Reader, get_writer_class(writer_name))
+    settings = copy.deepcopy(template)
+    settings.__dict__.update(settings_overrides)
+    return settings
+
+
+def parser_settings():
+    # As ``writer_settings``, for reading reST with the standalone reader.
+    template = SETTINGS_TEMPLATES.get(('parser', 'rst'))
+    if template is None:
+        template = SETTINGS_TEMPLATES[('parser', 'rst')] = default_settings(
+            standalone_reader.Reader, RstParser)
+    return copy.deepcopy(template)
+
+
+def stylesheet_key(settings):
+    # Writers read (and may embed) their stylesheets when they publish, so
+    # their output depends on those files as well as on the settings.
+    stylesheets = []
+    for setting in ('stylesheet_path', 'stylesheet'):
+        value = getattr(settings, setting, None) or ()
+        if isinstance(value, str):
+            value = value.split(',')
+        for path in value:
+            try:
+                stat = os.stat(path.strip())
+            except OSError:
+                stylesheets.append((path, None))
+            else:
+                stylesheets.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(stylesheets)
+
+
+def publish_key(doctree, writer_name, settings_overrides, settings):
+    try:
+        settings_key = frozenset(settings_overrides.items())
+    except TypeError:
+        # Unhashable setting values; this conversion just isn't cached.
+        return None
+    return (writer_name, settings_key, stylesheet_key(settings),
+        hash_input(doctree.pformat()))
+
+
+def publish(doctree, writer_name, settings_overrides, *args, **kwargs):
+    # Other publisher arguments (writer instances, destinations...) need the
+    # full publisher; plain conversions reuse the prepared writer settings.
+    if args or kwargs:
+        return publish_from_doctree(doctree, writer_name=writer_name,
+            settings_overrides=settings_overrides, *args, **kwargs)
+    return publish_from_doctree(doctree, writer_name=writer_name,
+        settings=writer_settings(writer_name, settings_overrides))
+
+
+def cached_publish(doctree, writer_name, settings_overrides, *args, **kwargs):
+    # Only plain conversions can be keyed on reliably, so only they are cached.
+    if args or kwargs:
+        return publish(doctree, writer_name, settings_overrides, *args,
+            **kwargs)
+    settings = writer_settings(writer_name, settings_overrides)
+    key = publish_key(doctree, writer_name, settings_overrides, settings)
+    if key is None:
+        return publish_from_doctree(doctree, writer_name=writer_name,
+            settings=settings)
+    output = PUBLISH_CACHE.get(key)
+    if output is not None:
+        return output
+    output = publish_from_doctree(doctree, writer_name=writer_name,
+        settings=settings)
+    PUBLISH_CACHE.set(key, output)
+    # The writer's transforms modify the doctree in place (and running them
+    # again gives different output), so remember the result under the
+    # tree's new state too.
+    new_key = publish_key(doctree, writer_name, settings_overrides, settings)
+    if new_key != key:
+        PUBLISH_CACHE.set(new_key, output)
+    return output
+
+class LRUCache (object):
+    
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            # Re-insert the value to mark it as the most recently used.
+            self._data[key] = value
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Default settings for each writer (and the reST parser), as built by
+# ``writer_settings`` and ``parser_settings``.
+SETTINGS_TEMPLATES = {}
+
+# Writer output, keyed on the writer, its settings and the doctree's contents.
+PUBLISH_CACHE = LRUCache(maxsize=64)
@@ -21,24 +21,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from copy import copy
+from collections import ChainMap
+import re
+from types import MappingProxyType
 
-from docutils.core import publish_from_doctree
-try:
-    import tidy
-except ImportError:
-    tidy = None
+from rst2a.common import LRUCache, cached_publish, hash_input, is_url
 
-from rst2a.common import is_url
+# utidylib is only imported when something is first tidied; see ``get_tidy``.
+_tidy = None
 
-DEFAULT_HTML_OVERRIDES = {
+STYLESHEET_NETLOCS = frozenset(('http', 'https', 'ftp'))
+
+# Tidied output, keyed by a hash of the untidied HTML and the tidy options,
+# so that converting the same document again skips tidy entirely.
+TIDY_CACHE = LRUCache(maxsize=256)
+
+# A cheap check for the kind of breakage tidy exists to repair: ampersands
+# which do not start an entity or character reference, and a ``<`` appearing
+# inside another tag.
+_TIDY_TRIGGER = re.compile(
+    br'&(?![A-Za-z][A-Za-z0-9]*;|#[0-9]+;|#[xX][0-9A-Fa-f]+;)|<[^<>]*<')
+
+DEFAULT_HTML_OVERRIDES = MappingProxyType({
     'no-generator': True,
     'no-datestamp': True,
     'no-source-link': True,
     'no-section-numbering': True
-}
+})
 
-DEFAULT_TIDY_XHTML_OPTIONS = {
+DEFAULT_TIDY_XHTML_OPTIONS = MappingProxyType({
     'add_xml_decl': True,
     'add_xml_space': True,
     'clean': True,
@@ -58,10 +69,10 @@ DEFAULT_TIDY_XHTML_OPTIONS = {
     'wrap': 79,
     'char_encoding': 'utf8',
     'tidy_mark': False
-}
+})
 
 
-DEFAULT_TIDY_HTML_OPTIONS = {
+DEFAULT_TIDY_HTML_OPTIONS = MappingProxyType({
     'clean': True,
     'css_prefix': 'tidystyle',
     'enclose_block_text': True,
@@ -80,29 +91,67 @@ DEFAULT_TIDY_HTML_OPTIONS = {
     'wrap': 79,
     'char_encoding': 'utf8',
     'tidy_mark': False
-}
+})
+
+
+def tidy_string(html_string, tidy_settings=DEFAULT_TIDY_HTML_OPTIONS):
+    key = (hash_input(html_string), frozenset(tidy_settings.items()))
+    tidied = TIDY_CACHE.get(key)
+    if tidied is None:
+        # Keep the encoded bytes, as the writer returns, whether the output is
+        # tidied or not.
+        tidied = get_tidy().parseString(html_string,
+            **tidy_settings).getvalue()
+        TIDY_CACHE.set(key, tidied)
+    return tidied
+
+def get_tidy():
+    global _tidy
+    if _tidy is None:
+        try:
+            import tidy
+        except (ImportError, OSError):
+            # utidylib raises OSError on import when libtidy itself is missing.
+            tidy = False
+        _tidy = tidy
+    return _tidy or None
+
+def needs_tidy(html_string):
+    if isinstance(html_string, str):
+        html_string = html_string.encode('utf8')
+    return _TIDY_TRIGGER.search(html_string) is not None
+
+def html_settings(settings, stylesheet_url=''):
+    # The settings are only ever read, so there is no need to copy them.
+    if is_url(stylesheet_url, net_loc=STYLESHEET_NETLOCS):
+        return ChainMap({'stylesheet-path': stylesheet_url}, settings)
+    return settings
 
 def doctree_to_html(doctree, stylesheet_url='',
     settings=DEFAULT_HTML_OVERRIDES, tidy_output=True,
     tidy_settings=DEFAULT_TIDY_HTML_OPTIONS, *args, **kwargs):
-    conversion_settings = copy(settings)
-    if tidy is None:
+    if get_tidy() is None:
         tidy_output = False
-    if is_url(stylesheet_url, net_loc=('http', 'ftp')):
-        conversion_settings['stylesheet-path'] = stylesheet_url
-    html_string = publish_from_doctree(doctree, writer_name='html4css1',
-        settings_overrides=conversion_settings, *args, **kwargs)
+    conversion_settings = html_settings(settings, stylesheet_url)
+    html_string = cached_publish(doctree, 'html4css1', conversion_settings,
+        *args, **kwargs)
+    # With ``tidy_output='auto'``, only run tidy when the output looks broken.
+    if tidy_output == 'auto':
+        tidy_output = needs_tidy(html_string)
     if tidy_output:
-        html_string = str(tidy.parseString(html_string, **tidy_settings))
+        html_string = tidy_string(html_string, tidy_settings)
     return html_string
 
 def doctree_to_xhtml(doctree, stylesheet_url='',
     settings=DEFAULT_HTML_OVERRIDES, tidy_settings=DEFAULT_TIDY_XHTML_OPTIONS,
     *args, **kwargs):
-    if tidy is None:
+    if get_tidy() is None:
         raise ImportError('utidylib must be present to convert to XHTML.')
     if 'tidy_output' in kwargs:
         del kwargs['tidy_output']
-    html_string = doctree_to_html(doctree, stylesheet_url, tidy_output=False,
+    # Publish and tidy directly, so that the output is only tidied once, with
+    # the XHTML options.
+    conversion_settings = html_settings(settings, stylesheet_url)
+    html_string = cached_publish(doctree, 'html4css1', conversion_settings,
         *args, **kwargs)
-    return str(tidy.parseString(html_string, **tidy_settings))
+    return tidy_string(html_string, tidy_settings)
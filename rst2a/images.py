@@ -22,103 +22,379 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from cStringIO import StringIO
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import hashlib
+import os
 from os.path import isdir, isfile, splitext
 from tempfile import mkdtemp, mkstemp
-from urllib2 import urlopen
+import threading
+from urllib.request import urlopen
 
 import docutils.nodes
-try:
-    import Image
-except ImportError:
-    Image = None
 
-from rst2a.common import is_url, stream_cp, reverse_lookup
+from rst2a.common import is_url, link_or_copy, remove_dir, stream_cp
+
+IMAGE_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg', '.gif', '.pdf'))
+# Formats pdflatex can include as they are; anything else is converted to PNG
+# (when PIL is available) on its way to the local file.
+LATEX_IMAGE_EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg', '.pdf'))
+
+# Where to keep downloaded images between runs, for localizers given
+# ``cache_dir=CACHE_DIR``: converting the same (or a similar) document again
+# then does not have to fetch them over the network. Cached images are never
+# fetched again, so this is only worth it for images which do not change.
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'rst2a', 'images')
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# PIL is only imported when an image is first checked or converted; see
+# ``get_image``.
+_Image = None
+
+# Likewise ``requests``, which (when installed) fetches HTTP images over
+# kept-alive connections; see ``get_session``.
+_session = None
+HTTP_NETLOCS = frozenset(('http', 'https'))
 
 
 class ImageURLError(Exception):
     pass
 
 
-class ImageLocalizer (docutils.nodes.SparseNodeVisitor):
+def local_extension(img_url):
+    img_ext = splitext(img_url)[1].lower()
+    if img_ext not in LATEX_IMAGE_EXTENSIONS and get_image() is not None:
+        return '.png'
+    return img_ext
+
+
+def cache_path(img_url, cache_dir=CACHE_DIR, img_ext=None):
+    # Cached images are stored in the format they were localized in, which
+    # need not be the one the URL suggests.
+    if img_ext is None:
+        img_ext = local_extension(img_url)
+    return os.path.join(cache_dir,
+        hashlib.sha1(img_url.encode('utf8')).hexdigest() + img_ext)
+
+
+def prune_cache(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    # Evict the least recently used images until the cache fits.
+    entries, total_size = [], 0
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+        total_size += stat.st_size
+    entries.sort()
+    for atime, size, path in entries:
+        if total_size <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total_size -= size
+
+
+def get_session(pool_size=16):
+    global _session
+    if _session is None:
+        try:
+            import requests
+            from requests.adapters import HTTPAdapter
+        except ImportError:
+            _session = False
+        else:
+            # One session for the whole process, so that connections to an
+            # image host are re-used across images and documents alike.
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session or None
+
+
+def get_image():
+    global _Image
+    if _Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = False
+        _Image = Image
+    return _Image or None
+
+
+class ImageLocalizer (object):
+    
+    # Downloads into the on-disk cache currently running in any localizer of
+    # this process, keyed by cache filename, so that documents converted at
+    # the same time (see ``ReSTDocument.convert_all``) fetch a shared image
+    # only once; the others wait for it and then copy it from the cache.
+    _shared_downloads = {}
+    _shared_lock = threading.Lock()
     
-    def __init__(self, document, check_images=False, local_mode=True):
+    def __init__(self, document, check_images=False, local_mode=True,
+        max_workers=16, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES,
+        timeout=10):
+        # Map remote URLs to local filenames, and local filenames back to the
+        # URLs they were downloaded from.
         self.localized_images = {}
+        self.reverse_map = {}
+        self._lock = threading.Lock()
+        # Image nodes (and their URLs) found during a walk, waiting to be
+        # downloaded by ``download_images``.
+        self.pending_images = []
+        # Downloads started by ``download_images(wait=False)`` which have not
+        # been waited for yet.
+        self._executor = None
+        self._futures = []
+        self.max_workers = max_workers
         self.check_images = check_images
-        self.temp_dir = mkdtemp(prefix='img_')
+        # The on-disk cache is only used when a ``cache_dir`` is given.
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        # Seconds to wait on an unresponsive server before giving up on an
+        # image, rather than holding up the whole conversion.
+        self.timeout = timeout
+        # Created on demand by ``make_temp_dir``: most documents are only
+        # ever converted to HTML, and never need it.
+        self.temp_dir = None
         self.__local_mode = local_mode
-        docutils.nodes.SparseNodeVisitor.__init__(self, document)
+        self.document = document
     
     def switch_mode(self):
         self.__local_mode = not self.__local_mode
     
+    def make_temp_dir(self):
+        if self.temp_dir is None or not isdir(self.temp_dir):
+            self.temp_dir = mkdtemp(prefix='img_')
+        return self.temp_dir
+    
+    def reserve_filename(self, img_url):
+        img_ext = splitext(img_url)[1].lower()
+        if img_ext not in IMAGE_EXTENSIONS:
+            raise ImageURLError('Unsupported image extension: "%s"' % (
+                img_ext,))
+        local_fd, local_filename = mkstemp(dir=self.make_temp_dir(),
+            suffix=local_extension(img_url))
+        os.close(local_fd)
+        return local_filename
+    
     def localize_image(self, img_url, local_filename=None):
         if local_filename is None:
-            local_filename = mkstemp(dir=self.temp_dir, suffix=img_ext)[1]
-        remote_handle = urlopen(img_url)
+            local_filename = self.reserve_filename(img_url)
+        if self.cache_dir is None:
+            return self.fetch_image(img_url, local_filename)
+        cached_filename = cache_path(img_url, self.cache_dir,
+            splitext(local_filename)[1].lower())
+        with self._shared_lock:
+            download = self._shared_downloads.get(cached_filename)
+            in_progress = download is not None
+            if not in_progress:
+                download = self._shared_downloads[cached_filename] = Future()
+        if in_progress:
+            # Raises whatever the other download failed with.
+            download.result()
+        else:
+            try:
+                fetched = not isfile(cached_filename)
+                if fetched:
+                    self.cache_image(img_url, local_filename, cached_filename)
+            except BaseException as exc:
+                download.set_exception(exc)
+                raise
+            else:
+                download.set_result(cached_filename)
+            finally:
+                with self._shared_lock:
+                    del self._shared_downloads[cached_filename]
+            if fetched:
+                return local_filename
+        if not isfile(cached_filename):
+            # Pruned by another conversion in the meantime.
+            return self.fetch_image(img_url, local_filename)
+        # Localized images are only ever read (and then deleted), so they can
+        # share their data with the cache entry.
+        link_or_copy(cached_filename, local_filename)
+        # Mark the entry as recently used, even on noatime filesystems.
+        os.utime(cached_filename, None)
+        return local_filename
+    
+    def cache_image(self, img_url, local_filename, cached_filename):
+        self.fetch_image(img_url, local_filename)
+        img_ext = splitext(local_filename)[1]
+        # Other downloads may be creating the directory at the same time.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Add to the cache under a temporary name and rename it into place so
+        # that concurrent conversions never see a partial image.
+        temp_fd, temp_filename = mkstemp(dir=self.cache_dir, suffix=img_ext)
+        os.close(temp_fd)
+        link_or_copy(local_filename, temp_filename)
+        os.replace(temp_filename, cached_filename)
+        prune_cache(self.cache_dir, self.cache_max_bytes)
+    
+    def fetch_image(self, img_url, local_filename):
+        session = is_url(img_url, net_loc=HTTP_NETLOCS) and \
+            get_session(self.max_workers)
+        if session:
+            response = session.get(img_url, stream=True,
+                timeout=self.timeout)
+            try:
+                response.raise_for_status()
+                local_handle = open(local_filename, 'wb')
+                try:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        local_handle.write(chunk)
+                finally:
+                    local_handle.close()
+            finally:
+                response.close()
+        else:
+            remote_handle = urlopen(img_url, timeout=self.timeout)
+            try:
+                local_handle = open(local_filename, 'wb')
+                try:
+                    stream_cp(remote_handle, local_handle)
+                finally:
+                    local_handle.close()
+            finally:
+                remote_handle.close()
         img_ext = splitext(img_url)[1].lower()
-        assert img_ext in ('.png', '.jpg', '.gif'), \
-            'Weird image extension: "%s"' % (img_ext,)
-        if self.check_images and Image is not None:
-            img_buffer = StringIO()
-            stream_cp(remote_handle, img_buffer)
-            img_buffer.seek(0)
-            img = Image.open(fp=img_buffer)
-            img.save(local_filename)
+        if img_ext not in LATEX_IMAGE_EXTENSIONS:
+            Image = get_image()
+        elif img_ext != '.pdf':
+            Image = self.check_images and get_image()
         else:
-            local_handle = open(local_filename, 'w')
-            stream_cp(remote_handle, local_handle)
-            local_handle.close()
-        remote_handle.close()
+            Image = None
+        if Image and img_ext not in LATEX_IMAGE_EXTENSIONS:
+            # Converting means decoding the image anyway, which checks it too.
+            img = Image.open(local_filename)
+            img.load()
+            img.save(local_filename)
+        elif Image:
+            try:
+                # ``verify`` only parses the image straight from the file, so
+                # a valid image never has to be decoded and encoded again.
+                Image.open(local_filename).verify()
+            except Exception:
+                # Fall back to re-saving anything ``verify`` rejects; an image
+                # which really is broken will fail here instead.
+                img = Image.open(local_filename)
+                img.load()
+                img.save(local_filename)
         return local_filename
     
-    def visit_image(self, img_node):
+    def process(self, doctree=None):
+        # Only image nodes are of interest, so iterate over those directly
+        # rather than dispatching on every node of the tree. Figures need no
+        # special handling, as their images are child ``image`` nodes.
+        if doctree is None:
+            doctree = self.document
+        # ``findall`` (docutils 0.18 and later) yields the nodes lazily;
+        # ``traverse`` builds a list of them, and is deprecated there.
+        find_nodes = getattr(doctree, 'findall', None) or doctree.traverse
+        for img_node in find_nodes(docutils.nodes.image):
+            self.handle_image(img_node)
+    
+    def handle_image(self, img_node):
         if self.__local_mode:
-            if not isdir(self.temp_dir):
-                self.temp_dir = mkdtemp(prefix='img_')
             img_url = img_node.attributes['uri']
             if isfile(img_url):
                 return
             if not is_url(img_url):
                 raise ImageURLError('Invalid image URL: "%s"' % (img_url,))
-            elif img_url in self.localized_images:
-                local_filename = self.localized_images[img_url]
-                if not isfile(temp_local_filename):
-                    self.localize_image(img_url, local_filename=local_filename)
-                img_node.attributes['uri'] = local_filename
-                return
-            else:
-                self.localized_images[img_url] = self.localize_image
+            # Downloads are deferred until the whole tree has been walked, so
+            # that they can run concurrently.
+            self.pending_images.append((img_node, img_url))
         else:
-            img_path = img_node.attributes['uri']
-            if not isfile(img_path) and not is_url(img_path):
-                raise ImageURLError('Invalid image URL: "%s"' % (img_path,))
-            if is_url(img_path):
-                return
-            elif isfile(img_path):
-                try:
-                    img_url = reverse_lookup(self.localized_images, img_path)
-                except ValueError:
-                    return
-                else:
-                    img_node.attributes['uri'] = img_url
-                    os.remove(img_path)
+            # One lookup in the reverse map per node; paths this localizer
+            # did not create are left alone.
+            img_url = self.reverse_map.get(img_node.attributes['uri'])
+            if img_url is not None:
+                img_node.attributes['uri'] = img_url
+    
+    def download_images(self, wait=True):
+        pending_images, self.pending_images = self.pending_images, []
+        # Fetch each URL only once, however many nodes refer to it. URLs which
+        # were localized by an earlier call keep their file, and are only
+        # fetched again (into the same file) if it has since been removed.
+        downloads, seen_urls = [], set()
+        for img_node, img_url in pending_images:
+            if img_url in seen_urls:
+                continue
+            seen_urls.add(img_url)
+            local_filename = self.localized_images.get(img_url)
+            if local_filename is None:
+                # Reserve the local file now, so that the doctree can point
+                # at it before the image has actually arrived.
+                local_filename = self.reserve_filename(img_url)
+                self.add_localized_image(img_url, local_filename)
+                downloads.append((img_url, local_filename))
+            elif not isfile(local_filename):
+                downloads.append((img_url, local_filename))
+        for img_node, img_url in pending_images:
+            img_node.attributes['uri'] = self.localized_images[img_url]
+        if downloads:
+            self.wait_for_downloads()
+            self._executor = ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(downloads)))
+            self._futures = [self._executor.submit(self.localize_image,
+                img_url, local_filename)
+                for img_url, local_filename in downloads]
+            if wait:
+                self.wait_for_downloads()
     
-    def visit_figure(self, figure_node):
-        return self.visit_image(figure_node)
+    def wait_for_downloads(self):
+        executor, futures = self._executor, self._futures
+        self._executor, self._futures = None, []
+        if executor is None:
+            return
+        try:
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            executor.shutdown(wait=True)
     
-    def localize_images(self, doctree):
-        old_dir = getcwdu()
-        chdir(self.temp_dir)
-        doctree.walk(self)
-        os.chdir(old_dir)
+    def add_localized_image(self, img_url, local_filename):
+        with self._lock:
+            self.localized_images[img_url] = local_filename
+            self.reverse_map[local_filename] = img_url
+    
+    def localize_images(self, doctree, wait=True):
+        # Temporary images are created with absolute paths inside
+        # ``self.temp_dir``, so there is no need to change the (process-wide)
+        # working directory. With ``wait=False`` the doctree is rewritten
+        # straight away, but the images are still on their way; call
+        # ``wait_for_downloads`` before anything reads them.
+        self.process(doctree)
+        self.download_images(wait=wait)
     
     def cleanup_images(self, doctree, delete_temp_dir=True):
-        self.switch_mode()
-        doctree.walk(self)
-        self.switch_mode()
-        if delete_temp_dir:
-            try:
-                os.rmdir(self.temp_dir)
-            except OSError:
-                pass
+        # A single pass restores the original URLs; the files themselves are
+        # then removed straight from the reverse map.
+        try:
+            self.wait_for_downloads()
+        except Exception:
+            # The images are about to be thrown away anyway.
+            pass
+        self.__local_mode = False
+        try:
+            self.process(doctree)
+        finally:
+            self.__local_mode = True
+        for img_path in self.reverse_map:
+            # Anything inside the temporary directory goes with it below.
+            if delete_temp_dir and \
+                os.path.dirname(img_path) == self.temp_dir:
+                continue
+            if isfile(img_path):
+                os.remove(img_path)
+        self.reverse_map.clear()
+        self.localized_images.clear()
+        if delete_temp_dir and self.temp_dir is not None:
+            remove_dir(self.temp_dir)
@@ -22,19 +22,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import ChainMap
+import os
 from os.path import isfile
+from types import MappingProxyType
 
-from docutils.core import publish_from_doctree
+from rst2a.common import publish, is_filelike, create_temp_file
 
-from rst2a.common import is_filelike, create_temp_file
-
-DEFAULT_LATEX_OVERRIDES = {
+DEFAULT_LATEX_OVERRIDES = MappingProxyType({
     'no-section-numbering': True,
     'documentoptions': '10pt,a4paper',
     'documentclass': 'article',
     'font-encoding': 'T1',
     'graphicx-option': 'pdftex'
-}
+})
 
 
 def doctree_to_latex(doctree, img_localizer, stylesheet_url='',
@@ -43,12 +44,29 @@ def doctree_to_latex(doctree, img_localizer, stylesheet_url='',
     if not isfile(str(stylesheet_url)) or is_filelike(stylesheet_url):
         stylesheet_url = create_temp_file(stylesheet_url, suffix='.tex')
         cleanup_stylesheet = True
-    conversion_settings = copy(settings)
-    conversion_settings['stylesheet-path'] = stylesheet_url
-    img_localizer.localize_images(doctree)
-    latex_string = publish_from_doctree(doctree, writer_name='latex',
-        settings_overrides=conversion_settings, *args, **kwargs)
-    temp_files = sorted(list(set(img_localizer.values())))
+    # Layer the stylesheet over the given settings instead of copying them.
+    conversion_settings = ChainMap({'stylesheet-path': stylesheet_url},
+        settings)
+    # The LaTeX writer only needs the images' local paths, not the images
+    # themselves, so let them download while the document is written.
+    try:
+        img_localizer.localize_images(doctree, wait=False)
+        try:
+            # The stylesheet and image paths are fresh temporary files on
+            # every call, so the output is never worth caching.
+            latex_string = publish(doctree, 'latex', conversion_settings,
+                *args, **kwargs)
+        finally:
+            img_localizer.wait_for_downloads()
+    except BaseException:
+        # The caller never gets to hear of the temporary files, and the
+        # doctree must not be left pointing at images which never arrived
+        # (a later conversion would take them for local files).
+        img_localizer.cleanup_images(doctree)
+        if cleanup_stylesheet:
+            os.remove(stylesheet_url)
+        raise
+    temp_files = sorted(img_localizer.reverse_map)
     if cleanup_stylesheet:
-        temp_files = [stylesheet_path] + temp_files
+        temp_files = [stylesheet_url] + temp_files
     return latex_string, temp_files
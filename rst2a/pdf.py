@@ -22,63 +22,167 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from tempfile import TemporaryDirectory
 import os
 import subprocess
 
 from rst2a import latex, common
 
+# pdflatex won't appear or vanish while we're running, so only look once.
+@lru_cache(maxsize=1)
 def pdflatex_installed():
     try:
-        subprocess.check_call(['pdflatex', '-version'])
-    except subprocess.CalledProcessError:
+        # The version banner is of no interest; keep it off the terminal.
+        subprocess.check_call(['pdflatex', '-version'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
         return False
     return True
 
-def call_pdflatex(latex_filename, pdf_dir=getcwdu()):
+@lru_cache(maxsize=1)
+def latexmk_installed():
     try:
-        subprocess.check_call(['pdflatex', '-halt-on-errors', latex_filename],
-            cwd=pdf_dir)
-    except subprocess.CalledProcessError, exc_instance:
-        return False, exc_instance.returncode
-    return True, 0
+        subprocess.check_call(['latexmk', '-v'], stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+def call_pdflatex(latex_filename, pdf_dir=None):
+    # Batch mode never stops to prompt on errors and keeps the terminal quiet;
+    # the details still end up in the .log file.
+    command = ['pdflatex', '-halt-on-error', '-interaction=batchmode',
+        latex_filename]
+    # No shell is involved, so odd filenames need no quoting; anything worth
+    # reading ends up in the .log file anyway.
+    return_code = subprocess.run(command, cwd=pdf_dir, check=False,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL).returncode
+    return return_code == 0, return_code
+
+# Messages LaTeX (and packages such as hyperref and longtable) leave in the
+# log when the document has to be typeset again to settle.
+RERUN_MARKERS = (b'Rerun to get', b'Label(s) may have changed', b'Rerun LaTeX')
+
+def log_path(latex_filename, pdf_dir=None):
+    log_filename = os.path.splitext(os.path.basename(latex_filename))[0] + \
+        os.extsep + 'log'
+    return os.path.join(pdf_dir or os.curdir, log_filename)
+
+def read_log(latex_filename, pdf_dir=None):
+    log_filename = log_path(latex_filename, pdf_dir=pdf_dir)
+    if not os.path.isfile(log_filename):
+        return None
+    with open(log_filename, 'rb') as log_handle:
+        return log_handle.read()
+
+def needs_rerun(latex_filename, pdf_dir=None):
+    log_data = read_log(latex_filename, pdf_dir=pdf_dir)
+    if log_data is None:
+        return False
+    return any(marker in log_data for marker in RERUN_MARKERS)
 
-def call_pdflatex_repeat(n, latex_filename, pdf_dir=getcwdu()):
+def last_pass_succeeded(latex_filename, pdf_dir=None):
+    # TeX starts every error message in the log with '! '.
+    pdf_filename = os.path.splitext(log_path(latex_filename,
+        pdf_dir=pdf_dir))[0] + os.extsep + 'pdf'
+    log_data = read_log(latex_filename, pdf_dir=pdf_dir)
+    return log_data is not None and b'\n! ' not in log_data and \
+        os.path.isfile(pdf_filename)
+
+def call_pdflatex_repeat(n, latex_filename, pdf_dir=None):
     if n == 0:
         return 0
+    # Run pdflatex again only while the log says the cross-references (or
+    # the table of contents, outlines...) are still changing; most documents
+    # are done after a single pass.
     success, return_code = call_pdflatex(latex_filename, pdf_dir=pdf_dir)
-    if not success:
-        return return_code
-    return call_pdflatex_repeat(n - 1, latex_filename, pdf_dir=pdf_dir)
+    for i in range(n - 1):
+        if not success or not needs_rerun(latex_filename, pdf_dir=pdf_dir):
+            break
+        success, return_code = call_pdflatex(latex_filename, pdf_dir=pdf_dir)
+    return return_code
+
+def call_latexmk(n, latex_filename, pdf_dir=None):
+    # latexmk works out for itself (from the log, and from which auxiliary
+    # files changed) how many pdflatex passes are needed; ``n`` caps them.
+    # -norc keeps the user's and the system's latexmkrc files (which may pick
+    # another engine, or a previewer) out of the build.
+    command = ['latexmk', '-norc', '-pdf', '-silent', '-interaction=batchmode',
+        '-halt-on-error', '-e', '$max_repeat=%d' % (n,), latex_filename]
+    return_code = subprocess.run(command, cwd=pdf_dir, check=False,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL).returncode
+    # latexmk also fails when the files are still changing after ``n``
+    # passes, where the pdflatex loop just stops; for both, the document
+    # compiled if the last pass did.
+    if return_code != 0 and last_pass_succeeded(latex_filename,
+        pdf_dir=pdf_dir):
+        return 0
+    return return_code
+
+def compile_latex(n, latex_filename, pdf_dir=None):
+    if n == 0:
+        return 0
+    # Having latexmk installed changes what drives the build: latexmk then
+    # runs pdflatex (with its own options) and decides when to stop, and
+    # ``call_pdflatex`` is not used at all.
+    if latexmk_installed():
+        return call_latexmk(n, latex_filename, pdf_dir=pdf_dir)
+    return call_pdflatex_repeat(n, latex_filename, pdf_dir=pdf_dir)
 
 def doctree_to_pdf(doctree, img_localizer, stylesheet_url='',
-    settings=latex.DEFAULT_LATEX_OVERRIDES, *args, **kwargs):
+    settings=latex.DEFAULT_LATEX_OVERRIDES, keep_images=False, dest=None,
+    *args, **kwargs):
     if not pdflatex_installed():
         raise EnvironmentError((127, 'pdflatex not installed.'))
-    cleanup_stylesheet = False
-    latex_string, extra_files = latex.doctree_to_latex(doctree, img_localizer,
-        settings=settings, stylesheet_url=stylesheet_url, *args, **kwargs)
-    if os.path.splitext(extra_files[0])[1] == '.tex':
-        cleanup_stylesheet = True
-    temp_pdf_dir = mkdtemp()
-    temp_latex_filename = common.create_temp_file(latex_string, suffix='.tex',
-        dir=temp_pdf_dir)
-    err = call_pdflatex_repeat(3, temp_latex_filename, pdf_dir=temp_pdf_dir)
-    if err == 0:
-        pdf_conversion_successful = True
-    else:
-        pdf_conversion_successful = False
-    img_localizer.cleanup_images(doctree)
-    if cleanup_stylesheet:
-        os.remove(extra_files[0])
-    if pdf_conversion_successful:
-        pdf_prefix = os.path.splitext(temp_latex_filename)[0]
-        pdf_filename = pdf_prefix + os.extsep + 'pdf'
-        pdf_handle = open(pdf_filename)
-        pdf_data = pdf_handle.read()
-        pdf_handle.close()
-        common.remove_dir(temp_pdf_dir)
-        return pdf_data
-    else:
-        common.remove_dir(temp_pdf_dir)
-        raise EnvironmentError((err, 'PDF conversion unsuccessful.'))
+    # Everything pdflatex writes goes into a temporary directory which is
+    # removed however the conversion ends.
+    with TemporaryDirectory(prefix='rst2a_') as temp_pdf_dir:
+        extra_files = []
+        try:
+            latex_string, extra_files = latex.doctree_to_latex(doctree,
+                img_localizer, settings=settings,
+                stylesheet_url=stylesheet_url, *args, **kwargs)
+            temp_latex_filename = common.create_temp_file(latex_string,
+                suffix='.tex', dir=temp_pdf_dir)
+            err = compile_latex(3, temp_latex_filename, pdf_dir=temp_pdf_dir)
+        finally:
+            # Localized images may be kept for a later conversion of the same
+            # doctree, in which case the caller is responsible for cleaning
+            # them up.
+            if not keep_images:
+                img_localizer.cleanup_images(doctree)
+            if extra_files and os.path.splitext(extra_files[0])[1] == '.tex':
+                os.remove(extra_files[0])
+        if err != 0:
+            raise EnvironmentError((err, 'PDF conversion unsuccessful.'))
+        pdf_filename = os.path.splitext(temp_latex_filename)[0] + \
+            os.extsep + 'pdf'
+        if dest is not None:
+            # Hand the PDF straight to the caller's file or socket, and
+            # return the number of bytes written instead of the data.
+            return common.send_file(pdf_filename, dest)
+        with open(pdf_filename, 'rb') as pdf_handle:
+            return pdf_handle.read()
+
+def doctree_to_pdf_batch(doctrees, img_localizers, max_workers=None, *args,
+    **kwargs):
+    # The heavy lifting is done by pdflatex in its own processes, so threads
+    # are enough to keep every core busy; each document gets its own
+    # temporary directory, and thus its own pdflatex working files.
+    doctrees, img_localizers = list(doctrees), list(img_localizers)
+    if len(doctrees) != len(img_localizers):
+        raise ValueError('%d doctrees given, but %d image localizers.' % (
+            len(doctrees), len(img_localizers)))
+    jobs = list(zip(doctrees, img_localizers))
+    if not jobs:
+        return []
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(jobs))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(doctree_to_pdf, doctree, img_localizer,
+            *args, **kwargs) for doctree, img_localizer in jobs]
+        return [future.result() for future in futures]
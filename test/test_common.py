@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for rst2a.common.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from rst2a import common
+
+
+class IsURLTest (unittest.TestCase):
+    
+    def test_default_netlocs(self):
+        self.assertTrue(common.is_url('http://example.com/a.png'))
+        self.assertTrue(common.is_url('sftp://example.com/a.png'))
+        self.assertFalse(common.is_url('file:///tmp/a.png'))
+        self.assertFalse(common.is_url('/tmp/a.png'))
+    
+    def test_string_netloc_is_matched_exactly(self):
+        self.assertTrue(common.is_url('http://example.com/', net_loc='http'))
+        # 'http' is a substring of 'https', but not the same scheme.
+        self.assertFalse(common.is_url('http://example.com/', net_loc='https'))
+        self.assertFalse(common.is_url('https://example.com/', net_loc='http'))
+    
+    def test_netloc_container(self):
+        net_locs = frozenset(('http', 'https'))
+        self.assertTrue(common.is_url('https://example.com/', net_locs))
+        self.assertFalse(common.is_url('ftp://example.com/', net_locs))
+
+
+class CreateTempFileTest (unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        common.remove_dir(self.temp_dir)
+    
+    def read(self, filename):
+        with open(filename, 'rb') as handle:
+            return handle.read()
+    
+    def test_contents(self):
+        for filein in ('été', b'\xc3\xa9t\xc3\xa9',
+            io.StringIO('été'), io.BytesIO(b'\xc3\xa9t\xc3\xa9')):
+            filename = common.create_temp_file(filein, dir=self.temp_dir)
+            self.assertEqual(self.read(filename), b'\xc3\xa9t\xc3\xa9')
+    
+    def test_bad_input_leaves_nothing_behind(self):
+        self.assertRaises(TypeError, common.create_temp_file, 42,
+            dir=self.temp_dir)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+    
+    def test_failed_read_leaves_nothing_behind(self):
+        class BrokenHandle (io.BytesIO):
+            def read(self, size=-1):
+                if size:
+                    raise IOError('read failed')
+                return b''
+        self.assertRaises(IOError, common.create_temp_file,
+            BrokenHandle(b'data'), dir=self.temp_dir)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+
+class SendFileTest (unittest.TestCase):
+    
+    def setUp(self):
+        self.data = os.urandom(200000)
+        self.filename = common.create_temp_file(self.data)
+    
+    def tearDown(self):
+        os.remove(self.filename)
+    
+    def test_to_buffer(self):
+        output = io.BytesIO()
+        self.assertEqual(common.send_file(self.filename, output),
+            len(self.data))
+        self.assertEqual(output.getvalue(), self.data)
+    
+    def test_to_file(self):
+        with tempfile.TemporaryFile() as output:
+            # Data already buffered in the handle has to come first.
+            output.write(b'head')
+            self.assertEqual(common.send_file(self.filename, output),
+                len(self.data))
+            output.seek(0)
+            self.assertEqual(output.read(), b'head' + self.data)
+    
+    def test_to_socket(self):
+        output, peer = socket.socketpair()
+        received = []
+        def receive():
+            while True:
+                chunk = peer.recv(65536)
+                if not chunk:
+                    break
+                received.append(chunk)
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        try:
+            self.assertEqual(common.send_file(self.filename, output),
+                len(self.data))
+        finally:
+            output.close()
+            receiver.join()
+            peer.close()
+        self.assertEqual(b''.join(received), self.data)
+
+
+class LRUCacheTest (unittest.TestCase):
+    
+    def test_get_and_set(self):
+        cache = common.LRUCache(maxsize=2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('a', 0), 0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIn('a', cache)
+        self.assertEqual(len(cache), 1)
+    
+    def test_least_recently_used_is_evicted(self):
+        cache = common.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # Reading 'a' makes 'b' the oldest entry.
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(len(cache), 2)
+    
+    def test_clear(self):
+        cache = common.LRUCache()
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for rst2a.html.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+
+import rst2a
+from rst2a import common, html
+
+DOCUMENT = '''Title
+=====
+
+Some *emphasis*, and a footnote [#]_.
+
+.. [#] The footnote.
+'''
+
+
+class NeedsTidyTest (unittest.TestCase):
+    
+    def test_clean_markup(self):
+        self.assertFalse(html.needs_tidy(
+            b'<p>Fish &amp; chips &#38; peas &#x26; <em>gravy</em></p>'))
+        self.assertFalse(html.needs_tidy('<p>caf\xe9</p>'))
+    
+    def test_bare_ampersand(self):
+        self.assertTrue(html.needs_tidy(b'<p>Fish & chips</p>'))
+        self.assertTrue(html.needs_tidy('<p>Fish &amp chips</p>'))
+    
+    def test_tag_inside_tag(self):
+        self.assertTrue(html.needs_tidy(b'<p <em>>text</p>'))
+    
+    def test_writer_output_is_clean(self):
+        self.assertFalse(html.needs_tidy(html.doctree_to_html(
+            rst2a.parse_document(DOCUMENT), tidy_output=False)))
+    
+    def test_auto_returns_bytes(self):
+        output = html.doctree_to_html(rst2a.parse_document(DOCUMENT),
+            tidy_output='auto')
+        self.assertIsInstance(output, bytes)
+
+
+class CachedPublishTest (unittest.TestCase):
+    
+    def setUp(self):
+        common.PUBLISH_CACHE.clear()
+        self.stylesheet = common.create_temp_file('p { color: red; }',
+            suffix='.css')
+        self.settings = dict(html.DEFAULT_HTML_OVERRIDES,
+            stylesheet_path=self.stylesheet, embed_stylesheet=True)
+    
+    def tearDown(self):
+        common.PUBLISH_CACHE.clear()
+        os.remove(self.stylesheet)
+    
+    def to_html(self):
+        return html.doctree_to_html(rst2a.parse_document(DOCUMENT),
+            settings=self.settings, tidy_output=False)
+    
+    def test_cached_output_matches_uncached(self):
+        uncached = common.publish(rst2a.parse_document(DOCUMENT),
+            'html4css1', self.settings)
+        self.assertEqual(self.to_html(), uncached)
+        self.assertEqual(len(common.PUBLISH_CACHE), 2)
+        self.assertEqual(self.to_html(), uncached)
+    
+    def test_published_tree_hits_the_cache(self):
+        # The writer changes the tree it publishes; the tree's new state is
+        # cached too, and publishing it again gives the same output.
+        doctree = rst2a.parse_document(DOCUMENT)
+        output = common.cached_publish(doctree, 'html4css1', self.settings)
+        self.assertEqual(common.cached_publish(doctree, 'html4css1',
+            self.settings), output)
+        self.assertEqual(len(common.PUBLISH_CACHE), 2)
+    
+    def test_stylesheet_change(self):
+        self.assertIn(b'color: red', self.to_html())
+        with open(self.stylesheet, 'w') as handle:
+            handle.write('p { color: blue; }')
+        # Make sure the change shows, however coarse the filesystem's clock.
+        stat = os.stat(self.stylesheet)
+        os.utime(self.stylesheet, ns=(stat.st_atime_ns,
+            stat.st_mtime_ns + 10 ** 9))
+        self.assertIn(b'color: blue', self.to_html())
+
+
+if __name__ == '__main__':
+    unittest.main()
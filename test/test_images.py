@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for rst2a.images.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import docutils.nodes
+
+import rst2a
+from rst2a import common, images, latex
+
+
+def image_data(format_name):
+    # A small, valid image in the given format, or None without PIL.
+    Image = images.get_image()
+    if Image is None:
+        return None
+    image_handle = io.BytesIO()
+    Image.new('RGB', (4, 4), (255, 0, 0)).save(image_handle, format_name)
+    return image_handle.getvalue()
+
+
+class ImageHandler (BaseHTTPRequestHandler):
+    
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        time.sleep(server.delay)
+        data = server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, *args):
+        pass
+
+
+class ImageServerTest (unittest.TestCase):
+    
+    # Paths served by the test server, and their contents.
+    files = {'/a.png': b'not really a PNG', '/b.jpg': b'not really a JPEG'}
+    # Seconds the server takes to answer each request.
+    delay = 0
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.files = self.files
+        self.server.delay = self.delay
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+    
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+    
+    def parse(self, *paths):
+        return rst2a.parse_document(''.join('.. image:: %s\n\n' % (
+            self.url(path),) for path in paths))
+    
+    def uris(self, doctree):
+        find_nodes = getattr(doctree, 'findall', None) or doctree.traverse
+        return [node['uri'] for node in find_nodes(docutils.nodes.image)]
+
+
+class LocalizeTest (ImageServerTest):
+    
+    def test_localize_and_restore(self):
+        doctree = self.parse('/a.png', '/b.jpg')
+        img_localizer = images.ImageLocalizer(doctree)
+        img_localizer.localize_images(doctree)
+        local_paths = self.uris(doctree)
+        for path, local_path in zip(('/a.png', '/b.jpg'), local_paths):
+            with open(local_path, 'rb') as handle:
+                self.assertEqual(handle.read(), self.files[path])
+            self.assertEqual(img_localizer.reverse_map[local_path],
+                self.url(path))
+        img_localizer.cleanup_images(doctree)
+        self.assertEqual(self.uris(doctree),
+            [self.url('/a.png'), self.url('/b.jpg')])
+        self.assertFalse(any(os.path.exists(path) for path in local_paths))
+        self.assertFalse(os.path.exists(img_localizer.temp_dir))
+        self.assertEqual(img_localizer.reverse_map, {})
+        self.assertEqual(img_localizer.localized_images, {})
+    
+    def test_each_url_is_fetched_once(self):
+        doctree = self.parse('/a.png', '/b.jpg', '/a.png')
+        img_localizer = images.ImageLocalizer(doctree)
+        img_localizer.localize_images(doctree)
+        self.addCleanup(img_localizer.cleanup_images, doctree)
+        local_paths = self.uris(doctree)
+        self.assertEqual(local_paths[0], local_paths[2])
+        self.assertEqual(sorted(self.server.requests), ['/a.png', '/b.jpg'])
+        # Localizing another tree reuses the files from the first pass...
+        other_doctree = self.parse('/a.png', '/b.jpg')
+        img_localizer.localize_images(other_doctree)
+        self.assertEqual(self.uris(other_doctree), local_paths[:2])
+        self.assertEqual(len(self.server.requests), 2)
+        # ... and fetches a removed one again, into the same file.
+        os.remove(local_paths[0])
+        third_doctree = self.parse('/a.png')
+        img_localizer.localize_images(third_doctree)
+        self.assertEqual(self.uris(third_doctree), local_paths[:1])
+        self.assertTrue(os.path.isfile(local_paths[0]))
+        self.assertEqual(self.server.requests[2:], ['/a.png'])
+    
+    def test_no_temp_dir_without_images(self):
+        doctree = rst2a.parse_document('No images here.\n')
+        img_localizer = images.ImageLocalizer(doctree)
+        img_localizer.localize_images(doctree)
+        img_localizer.cleanup_images(doctree)
+        self.assertIsNone(img_localizer.temp_dir)
+
+
+class SharedDownloadTest (ImageServerTest):
+    
+    # Long enough for every localizer to ask for the image while the first
+    # download is still running.
+    delay = 0.5
+    
+    def test_concurrent_localizers_share_a_download(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(common.remove_dir, cache_dir)
+        doctrees = [self.parse('/a.png') for i in range(4)]
+        img_localizers = [images.ImageLocalizer(doctree, cache_dir=cache_dir)
+            for doctree in doctrees]
+        threads = [threading.Thread(target=img_localizer.localize_images,
+            args=(doctree,))
+            for doctree, img_localizer in zip(doctrees, img_localizers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests, ['/a.png'])
+        for doctree, img_localizer in zip(doctrees, img_localizers):
+            self.addCleanup(img_localizer.cleanup_images, doctree)
+            with open(self.uris(doctree)[0], 'rb') as handle:
+                self.assertEqual(handle.read(), self.files['/a.png'])
+        # Later localizers find the image in the cache.
+        doctree = self.parse('/a.png')
+        img_localizer = images.ImageLocalizer(doctree, cache_dir=cache_dir)
+        img_localizer.localize_images(doctree)
+        self.addCleanup(img_localizer.cleanup_images, doctree)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+@unittest.skipIf(images.get_image() is None, 'PIL is not installed')
+class CheckImagesTest (ImageServerTest):
+    
+    files = {'/good.png': image_data('PNG'), '/bad.png': b'not a PNG'}
+    
+    def test_valid_image(self):
+        doctree = self.parse('/good.png')
+        img_localizer = images.ImageLocalizer(doctree, check_images=True)
+        img_localizer.localize_images(doctree)
+        self.addCleanup(img_localizer.cleanup_images, doctree)
+        with open(self.uris(doctree)[0], 'rb') as handle:
+            self.assertEqual(handle.read(), self.files['/good.png'])
+    
+    def test_broken_image(self):
+        doctree = self.parse('/bad.png')
+        img_localizer = images.ImageLocalizer(doctree, check_images=True)
+        self.assertRaises(Exception, latex.doctree_to_latex, doctree,
+            img_localizer)
+        # The tree is not left pointing at the rejected download.
+        self.assertEqual(self.uris(doctree), [self.url('/bad.png')])
+        self.assertEqual(img_localizer.reverse_map, {})
+
+
+
+@unittest.skipIf(images.get_image() is None, 'PIL is not installed')
+class ConversionTest (ImageServerTest):
+    
+    files = {'/c.gif': image_data('GIF'), '/d.jpg': image_data('JPEG')}
+    
+    def localize(self, path):
+        doctree = self.parse(path)
+        img_localizer = images.ImageLocalizer(doctree)
+        img_localizer.localize_images(doctree)
+        self.addCleanup(img_localizer.cleanup_images, doctree)
+        return self.uris(doctree)[0]
+    
+    def test_gif_becomes_png(self):
+        local_path = self.localize('/c.gif')
+        self.assertEqual(os.path.splitext(local_path)[1], '.png')
+        with images.get_image().open(local_path) as img:
+            self.assertEqual(img.format, 'PNG')
+    
+    def test_latex_safe_image_is_untouched(self):
+        local_path = self.localize('/d.jpg')
+        self.assertEqual(os.path.splitext(local_path)[1], '.jpg')
+        with open(local_path, 'rb') as handle:
+            self.assertEqual(handle.read(), self.files['/d.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
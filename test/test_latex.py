@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for rst2a.latex.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import unittest
+
+import docutils.nodes
+
+import rst2a
+from rst2a import images, latex
+
+
+def closed_port():
+    # A port on which nothing listens, so that connecting is refused.
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class FailedDownloadTest (unittest.TestCase):
+    
+    def setUp(self):
+        self.img_url = 'http://127.0.0.1:%d/missing.png' % (closed_port(),)
+        self.doctree = rst2a.parse_document('.. image:: %s\n' % (
+            self.img_url,))
+        self.img_localizer = images.ImageLocalizer(self.doctree, timeout=5)
+    
+    def uris(self):
+        find_nodes = getattr(self.doctree, 'findall', None) or \
+            self.doctree.traverse
+        return [node['uri'] for node in find_nodes(docutils.nodes.image)]
+    
+    def test_doctree_is_restored(self):
+        self.assertRaises(Exception, latex.doctree_to_latex, self.doctree,
+            self.img_localizer)
+        self.assertEqual(self.uris(), [self.img_url])
+        self.assertEqual(self.img_localizer.reverse_map, {})
+        temp_dir = self.img_localizer.temp_dir
+        self.assertFalse(temp_dir is not None and os.path.exists(temp_dir))
+    
+    def test_retry_fails_again(self):
+        # Rather than "succeeding" against an empty placeholder file.
+        for i in range(2):
+            self.assertRaises(Exception, latex.doctree_to_latex,
+                self.doctree, self.img_localizer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for rst2a.pdf.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from rst2a import common, pdf
+
+
+class NeedsRerunTest (unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.latex_filename = os.path.join(self.temp_dir, 'doc.tex')
+    
+    def tearDown(self):
+        common.remove_dir(self.temp_dir)
+    
+    def write_log(self, data):
+        with open(os.path.join(self.temp_dir, 'doc.log'), 'wb') as handle:
+            handle.write(data)
+    
+    def test_no_log(self):
+        self.assertFalse(pdf.needs_rerun(self.latex_filename,
+            pdf_dir=self.temp_dir))
+    
+    def test_settled_log(self):
+        self.write_log(b'Output written on doc.pdf (1 page).\n')
+        self.assertFalse(pdf.needs_rerun(self.latex_filename,
+            pdf_dir=self.temp_dir))
+    
+    def test_rerun_markers(self):
+        for marker in pdf.RERUN_MARKERS:
+            self.write_log(b'LaTeX Warning: ' + marker + b'.\n')
+            self.assertTrue(pdf.needs_rerun(self.latex_filename,
+                pdf_dir=self.temp_dir))
+
+
+class BatchTest (unittest.TestCase):
+    
+    def test_mismatched_lengths(self):
+        self.assertRaises(ValueError, pdf.doctree_to_pdf_batch, [None],
+            [None, None])
+    
+    def test_empty(self):
+        self.assertEqual(pdf.doctree_to_pdf_batch([], []), [])
+
+
+# Stands in for latexmk: writes the PDF and the log it is told to, then exits
+# with the status it is told to.
+FAKE_LATEXMK = '''#!/bin/sh
+[ "$1" = "-v" ] && exit 0
+for arg; do tex="$arg"; done
+base="${tex%.tex}"
+printf '%%PDF-1.4\\n' > "$base.pdf"
+printf '%s\\n' "$FAKE_LATEXMK_LOG" > "$base.log"
+exit $FAKE_LATEXMK_STATUS
+'''
+
+
+@unittest.skipUnless(os.name == 'posix', 'needs a shell script on PATH')
+class LatexmkTest (unittest.TestCase):
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        bin_dir = os.path.join(self.temp_dir, 'bin')
+        os.mkdir(bin_dir)
+        latexmk = os.path.join(bin_dir, 'latexmk')
+        with open(latexmk, 'w') as handle:
+            handle.write(FAKE_LATEXMK)
+        os.chmod(latexmk, stat.S_IRWXU)
+        self.latex_filename = common.create_temp_file(b'', suffix='.tex',
+            dir=self.temp_dir)
+        environ = mock.patch.dict(os.environ,
+            PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+        environ.start()
+        self.addCleanup(environ.stop)
+        pdf.latexmk_installed.cache_clear()
+        self.addCleanup(pdf.latexmk_installed.cache_clear)
+    
+    def tearDown(self):
+        common.remove_dir(self.temp_dir)
+    
+    def compile_latex(self, log, status):
+        with mock.patch.dict(os.environ, FAKE_LATEXMK_LOG=log,
+            FAKE_LATEXMK_STATUS=str(status)):
+            return pdf.compile_latex(3, self.latex_filename,
+                pdf_dir=self.temp_dir)
+    
+    def test_success(self):
+        self.assertEqual(self.compile_latex('Output written.', 0), 0)
+    
+    def test_unsettled_after_max_repeat(self):
+        # As with the pdflatex loop, the last pass's success is what counts.
+        self.assertEqual(self.compile_latex(
+            'Label(s) may have changed. Rerun to get cross-references right.',
+            12), 0)
+    
+    def test_latex_error(self):
+        self.assertEqual(self.compile_latex(
+            'Starting.\n! Undefined control sequence.', 12), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
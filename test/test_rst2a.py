@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Tests for the main rst2a module.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import unittest
+
+import docutils.nodes
+
+import rst2a
+
+from test_images import ImageServerTest
+
+DOCUMENT = '''Title
+=====
+
+A paragraph.
+
+.. image:: http://example.com/a.png
+'''
+
+
+def image_nodes(doctree):
+    find_nodes = getattr(doctree, 'findall', None) or doctree.traverse
+    return list(find_nodes(docutils.nodes.image))
+
+
+class ParseDocumentTest (unittest.TestCase):
+    
+    def setUp(self):
+        rst2a.DOCTREE_CACHE.clear()
+    
+    def test_cached(self):
+        rst2a.parse_document(DOCUMENT)
+        self.assertEqual(len(rst2a.DOCTREE_CACHE), 1)
+        rst2a.parse_document(DOCUMENT)
+        self.assertEqual(len(rst2a.DOCTREE_CACHE), 1)
+    
+    def test_copies_are_independent(self):
+        first = rst2a.parse_document(DOCUMENT)
+        first_image = image_nodes(first)[0]
+        first_image['uri'] = '/tmp/a.png'
+        second = rst2a.parse_document(DOCUMENT)
+        self.assertIsNot(first, second)
+        self.assertEqual(image_nodes(second)[0]['uri'],
+            'http://example.com/a.png')
+        # The copies still work with the rest of docutils.
+        self.assertIsNotNone(second.reporter)
+        self.assertIsNotNone(second.transformer)
+        self.assertEqual(second.pformat(),
+            rst2a.parse_document(DOCUMENT).pformat())
+
+
+
+class ConvertAllTest (ImageServerTest):
+    
+    def setUp(self):
+        super(ConvertAllTest, self).setUp()
+        self.source = 'Title\n=====\n\n.. image:: %s\n' % (
+            self.url('/a.png'),)
+        self.document = rst2a.ReSTDocument(io.StringIO(self.source))
+    
+    def test_formats(self):
+        self.assertEqual(self.document.convert_all(()), {})
+        self.assertRaises(ValueError, self.document.convert_all, ('rtf',))
+    
+    def test_html_and_latex(self):
+        results = self.document.convert_all(('html', 'latex'))
+        self.addCleanup(self.document.cleanup_images)
+        self.assertEqual(sorted(results), ['html', 'latex'])
+        self.assertEqual(results['html'], rst2a.ReSTDocument(
+            io.StringIO(self.source)).to_html())
+        latex_string, temp_files = results['latex']
+        self.assertIn(b'\\begin{document}', latex_string)
+        # The conversions worked on copies of the document.
+        self.assertEqual(image_nodes(self.document.document)[0]['uri'],
+            self.url('/a.png'))
+        # The LaTeX images belong to the document's own localizer, so its
+        # ``cleanup_images`` removes them.
+        stylesheet, image_files = temp_files[0], temp_files[1:]
+        os.remove(stylesheet)
+        self.assertEqual(len(image_files), 1)
+        self.assertTrue(os.path.isfile(image_files[0]))
+        self.document.cleanup_images()
+        self.assertFalse(os.path.exists(image_files[0]))
+        self.assertFalse(os.path.exists(self.document.img_localizer.temp_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()